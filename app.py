@@ -1,26 +1,66 @@
+import hashlib
 import os
+import time
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, make_response)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import delete, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+from sqlalchemy.pool import StaticPool
 from werkzeug.exceptions import Unauthorized
 
 from forms import (UserAddForm,
                 LoginForm, MessageForm, CSRFProtectForm, UserEditForm)
-from models import db, connect_db, User, Message
+from models import (db, connect_db, User, Message, Follow, Like,
+                    UsernameTakenError)
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
+# Pages that are identical for every anonymous visitor (no forms, so no
+# per-session CSRF token), which shared caches may keep for a minute
+PUBLIC_ANON_ENDPOINTS = {"homepage"}
+
 app = Flask(__name__)
 
+# set by the test suite before importing the app
+app.config['TESTING'] = os.environ.get('FLASK_TESTING') == '1'
+
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+if app.config['TESTING']:
+    # tests use one connection at a time (one per test class); keep reusing
+    # it rather than reconnecting, and skip the pre-ping
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': StaticPool,
+        'pool_pre_ping': False,
+    }
+else:
+    # Per-process pool: size it so (pool_size + max_overflow) * gunicorn
+    # workers stays under the server's max_connections. In production,
+    # point DATABASE_URL at pgbouncer (transaction pooling) instead.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+    }
+
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-toolbar = DebugToolbarExtension(app)
+# bcrypt work factor for new password hashes; tests turn this down
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+if not app.config['TESTING']:
+    toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
@@ -36,18 +76,47 @@ def add_to_g():
     add_csrf_form_to_g()
 
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    The user's following/followers are loaded up front, since nearly every
+    page checks them (nav, follow buttons, stats) and lazy-loading them
+    would cost an extra query each. Email and password hash are left
+    unloaded until something (profile edit, login check) asks for them.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = db.session.get(
+            User,
+            session[CURR_USER_KEY],
+            options=[
+                load_only(
+                    User.id,
+                    User.username,
+                    User.image_url,
+                    User.header_image_url,
+                    User.bio,
+                    User.location,
+                ),
+                selectinload(User.following),
+                selectinload(User.followers),
+            ],
+        )
 
     else:
         g.user = None
 
 def add_csrf_form_to_g():
-    """Add csrf form to Flask global."""
+    """Add csrf form to Flask global.
 
-    g.csrf_form = CSRFProtectForm()
+    Pages only render CSRF-protected forms for logged-in users, so an
+    anonymous GET skips building one.
+    """
+
+    if g.user or request.method == "POST":
+        g.csrf_form = CSRFProtectForm()
+
+    else:
+        g.csrf_form = None
 
 
 def do_login(user):
@@ -59,8 +128,7 @@ def do_login(user):
 def do_logout():
     """Log out user."""
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    session.pop(CURR_USER_KEY, None)
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -89,7 +157,7 @@ def signup():
             )
             db.session.commit()
 
-        except IntegrityError:
+        except (IntegrityError, UsernameTakenError):
             flash("Username or email already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
@@ -137,6 +205,49 @@ def logout():
     return redirect("/")
 
 
+##############################################################################
+# Conditional GET helpers:
+
+def page_etag(*parts):
+    """Build an ETag for a page rendered for g.user from `parts`.
+
+    `parts` are the values the page's content depends on. The current user is
+    always included (nav bar, follow/like buttons), and so is what the page's
+    CSRF tokens are signed against: the session's raw token (a new session
+    means the old copy's forms would fail) and, if tokens expire, the time
+    window, half the limit long so a revalidated copy's tokens are still
+    valid.
+    """
+
+    csrf_raw = session.get(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    csrf_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_window = (
+        int(time.time() // (csrf_limit / 2)) if csrf_limit else None)
+    user = (g.user.id, g.user.username, g.user.image_url)
+
+    return hashlib.md5(
+        repr((user, csrf_raw, csrf_window, parts)).encode()).hexdigest()
+
+
+def render_conditional(etag, template, **context):
+    """Render `template`, or send 304 if the client's copy matches `etag`.
+
+    Pages with pending flash messages are always rendered and left untagged,
+    since the flashes get baked into that copy of the HTML.
+    """
+
+    if session.get('_flashes'):
+        return render_template(template, **context)
+
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag)
+    return response
+
+
 ##############################################################################
 # General user routes:
 
@@ -153,25 +264,57 @@ def list_users():
 
     search = request.args.get('q')
 
+    # only the columns the user cards show
+    query = User.query.options(load_only(
+        User.id,
+        User.username,
+        User.image_url,
+        User.header_image_url,
+        User.bio,
+    ))
+
     if not search:
-        users = User.query.all()
+        users = query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = (query
+                 .filter(User.username.ilike(f"%{search}%"))
+                 .order_by(User.username)
+                 .limit(50)
+                 .all())
 
     return render_template('users/index.html', users=users)
 
 
 @app.get('/users/<int:user_id>')
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    The page's queries still run to build the ETag; a 304 only saves
+    rendering and sending the template.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
+
+    liked_ids = {message.id for message in g.user.messages_liked}
+    etag = page_etag(
+        user.id,
+        user.username,
+        user.image_url,
+        user.header_image_url,
+        user.bio,
+        user.location,
+        [(message.id, message.id in liked_ids) for message in user.messages],
+        len(user.following),
+        len(user.followers),
+        len(user.messages_liked),
+        g.user.is_following(user),
+    )
 
-    return render_template('users/show.html', user=user)
+    return render_conditional(etag, 'users/show.html', user=user)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -182,7 +325,7 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     return render_template('users/following.html', user=user)
 
 
@@ -194,7 +337,7 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     return render_template('users/followers.html', user=user)
 
 
@@ -206,13 +349,13 @@ def show_liked_messages(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    messages_ids_to_show = [message.id for  message in user.messages_liked]
+    user = db.get_or_404(User, user_id)
 
     messages = (Message
                 .query
-                .filter(Message.id.in_(messages_ids_to_show))
+                .join(Like, Like.message_id == Message.id)
+                .filter(Like.user_id == user_id)
+                .options(selectinload(Message.user))
                 .order_by(Message.timestamp.desc())
                 .all())
 
@@ -231,7 +374,7 @@ def start_following(follow_id):
     if not form.validate_on_submit() or not g.user:
         raise Unauthorized()
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = db.get_or_404(User, follow_id)
 
     if g.user.id == follow_id:
         flash("You cannot follow yourself!", "danger")
@@ -255,7 +398,7 @@ def stop_following(follow_id):
     if not form.validate_on_submit() or not g.user:
         raise Unauthorized()
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = db.get_or_404(User, follow_id)
 
     if followed_user in g.user.following:
         g.user.following.remove(followed_user)
@@ -266,12 +409,24 @@ def stop_following(follow_id):
 
 @app.route('/users/profile', methods=["GET", "POST"])
 def update_profile():
-    """Update profile for current user."""
+    """Update profile for current user.
+
+    The form is filled from explicit values rather than obj=g.user, which
+    would read (and so load) the password hash the form never shows. Only
+    email costs a SELECT, since add_user_to_g leaves it unloaded.
+    """
 
     if not g.user:
         raise Unauthorized()
 
-    form = UserEditForm(obj=g.user)
+    form = UserEditForm(
+        username=g.user.username,
+        email=g.user.email,
+        location=g.user.location,
+        bio=g.user.bio,
+        image_url=g.user.image_url,
+        header_image_url=g.user.header_image_url,
+    )
 
     if form.validate_on_submit() and g.user:
 
@@ -282,13 +437,16 @@ def update_profile():
 
         if user:
 
-            username_check = (user.username != form.username.data and
-                User.query.filter_by(username=form.username.data)
-                .one_or_none())
+            taken = (User
+                     .query
+                     .with_entities(User.username, User.email)
+                     .filter(User.id != user.id)
+                     .filter(or_(User.username == form.username.data,
+                                 User.email == form.email.data))
+                     .all())
 
-            email_check = (user.email != form.email.data and
-                User.query.filter_by(email=form.email.data)
-                .one_or_none())
+            username_check = form.username.data in {t.username for t in taken}
+            email_check = form.email.data in {t.email for t in taken}
 
             if username_check or email_check:
 
@@ -335,13 +493,13 @@ def delete_user():
 
     do_logout()
 
-    for message in g.user.messages:
-        db.session.delete(message)
-
-    db.session.delete(g.user)
+    # messages, likes and follows all reference users ON DELETE CASCADE, so
+    # one DELETE lets Postgres clean up everything belonging to this user
+    username = g.user.username
+    db.session.execute(delete(User).where(User.id == g.user.id))
     db.session.commit()
 
-    flash(f"Deleted {g.user.username}!", "success")
+    flash(f"Deleted {username}!", "success")
 
     return redirect("/signup")
 
@@ -350,6 +508,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
+
 @app.route('/messages/new', methods=["GET", "POST"])
 def add_message():
     """Add a message:
@@ -363,11 +522,14 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
+        # read before the commit expires g.user, which would reload it
+        user_id = g.user.id
+
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
         db.session.commit()
 
-        return redirect(f"/users/{g.user.id}")
+        return redirect(f"/users/{user_id}")
 
     return render_template('messages/create.html', form=form)
 
@@ -380,8 +542,23 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = db.get_or_404(Message, message_id)
+
+    # follow/like buttons are only shown on other users' messages
+    is_own = msg.user_id == g.user.id
+
+    etag = page_etag(
+        msg.id,
+        msg.text,
+        msg.timestamp,
+        msg.user.id,
+        msg.user.username,
+        msg.user.image_url,
+        is_own or g.user.is_following(msg.user),
+        is_own or g.user.is_liked_by(msg),
+    )
+
+    return render_conditional(etag, 'messages/show.html', message=msg)
 
 
 @app.post('/messages/<int:message_id>/delete')
@@ -397,15 +574,17 @@ def delete_message(message_id):
     if not form.validate_on_submit() or not g.user:
         raise Unauthorized()
 
-    msg = Message.query.get_or_404(message_id)
+    msg = db.get_or_404(Message, message_id)
+
+    user_id = g.user.id
 
-    if msg.user_id != g.user.id:
+    if msg.user_id != user_id:
         raise Unauthorized()
 
     db.session.delete(msg)
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}")
+    return redirect(f"/users/{user_id}")
 
 
 @app.post('/messages/<int:message_id>/like')
@@ -420,15 +599,22 @@ def like_message(message_id):
     if not form.validate_on_submit() or not g.user:
         raise Unauthorized()
 
-    message_to_like = Message.query.get_or_404(message_id)
+    message_to_like = db.get_or_404(Message, message_id)
 
     # like button hidden for own messages, but also catching here
     if g.user.id == message_to_like.user_id:
         flash("You cannot like your own Warble!", "danger")
 
-    elif message_to_like not in g.user.messages_liked:
-        g.user.messages_liked.append(message_to_like)
-        db.session.commit()
+    else:
+        # likes' primary key makes liking twice a no-op
+        result = db.session.execute(
+            pg_insert(Like)
+            .values(user_id=g.user.id, message_id=message_id)
+            .on_conflict_do_nothing()
+        )
+
+        if result.rowcount:
+            db.session.commit()
 
     return redirect(
         request.form.get('referring_page', f'/messages/{message_id}'))
@@ -446,10 +632,15 @@ def unlike_message(message_id):
     if not form.validate_on_submit() or not g.user:
         raise Unauthorized()
 
-    message_to_unlike = Message.query.get_or_404(message_id)
+    message_to_unlike = db.get_or_404(Message, message_id)
 
-    if message_to_unlike in g.user.messages_liked:
-        g.user.messages_liked.remove(message_to_unlike)
+    result = db.session.execute(
+        delete(Like)
+        .where(Like.user_id == g.user.id)
+        .where(Like.message_id == message_id)
+    )
+
+    if result.rowcount:
         db.session.commit()
 
     return redirect(
@@ -474,11 +665,14 @@ def homepage():
 
     if g.user:
 
-        user_ids_to_show = [user.id for user in g.user.following] + [g.user.id]
+        followed_user_ids = (select(Follow.user_being_followed_id)
+                             .where(Follow.user_following_id == g.user.id))
 
         messages = (Message
                     .query
-                    .filter(Message.user_id.in_(user_ids_to_show))
+                    .filter(or_(Message.user_id.in_(followed_user_ids),
+                                Message.user_id == g.user.id))
+                    .options(selectinload(Message.user))
                     .order_by(Message.timestamp.desc())
                     .limit(100)
                     .all())
@@ -486,13 +680,35 @@ def homepage():
         return render_template('home.html', messages=messages)
 
     else:
-        return render_template('home-anon.html')
+        response = make_response(render_template('home-anon.html'))
+        response.add_etag()
+        return response.make_conditional(request)
 
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers on every request.
+
+    Anonymous views of the public pages may be cached by proxies for a
+    minute, unless this response changed the session (e.g. showed a flash).
+    Other pages with an ETag may be kept by the browser but must be
+    revalidated; everything else is never stored.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if (not g.get('user')
+            and request.endpoint in PUBLIC_ANON_ENDPOINTS
+            and response.status_code in (200, 304)
+            and not session.modified):
+        response.cache_control.public = True
+        response.cache_control.max_age = 60
+        response.vary.add('Cookie')
+
+    elif response.get_etag()[0]:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    else:
+        response.cache_control.no_store = True
+
     return response
@@ -2,8 +2,10 @@
 
 from datetime import datetime
 
+from flask import current_app
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, or_, select
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -18,6 +20,10 @@ DEFAULT_HEADER_IMAGE_URL = (
     "mat&fit=crop&w=2070&q=80")
 
 
+class UsernameTakenError(ValueError):
+    """Raised by User.signup when the username or email is already in use."""
+
+
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -35,6 +41,17 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads with the followed user; this serves "who does
+    # this user follow" (homepage timeline, following page)
+    __table_args__ = (
+        db.Index(
+            'ix_follows_following_id_followed_id',
+            user_following_id,
+            user_being_followed_id,
+            unique=True,
+        ),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -101,7 +118,25 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follow.user_being_followed_id == id),
         secondaryjoin=(Follow.user_following_id == id),
-        backref="following",
+        back_populates="following",
+    )
+
+    following = db.relationship(
+        "User",
+        secondary="follows",
+        primaryjoin=(Follow.user_following_id == id),
+        secondaryjoin=(Follow.user_being_followed_id == id),
+        back_populates="followers",
+    )
+
+    # trigram index so the leading-wildcard username search can use an index
+    __table_args__ = (
+        db.Index(
+            'ix_users_username_trgm',
+            username,
+            postgresql_using='gin',
+            postgresql_ops={'username': 'gin_trgm_ops'},
+        ),
     )
 
     def __repr__(self):
@@ -111,10 +146,27 @@ class User(db.Model):
     def signup(cls, username, email, password, image_url=DEFAULT_IMAGE_URL):
         """Sign up user.
 
-        Hashes password and adds user to session.
+        Hashes password and adds user to session. The bcrypt cost comes from
+        the app's BCRYPT_LOG_ROUNDS setting, if any (tests turn it down).
+
+        Raises UsernameTakenError if the username or email is already taken,
+        before hashing anything. The unique constraints still back this up
+        for signups that race each other (IntegrityError on commit).
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        taken = db.session.execute(
+            select(User.id)
+            .where(or_(User.username == username, User.email == email))
+            .limit(1)
+        ).first()
+
+        if taken:
+            raise UsernameTakenError("Username or email already taken")
+
+        hashed_pwd = bcrypt.generate_password_hash(
+            password,
+            rounds=current_app.config.get('BCRYPT_LOG_ROUNDS'),
+        ).decode('UTF-8')
 
         user = User(
             username=username,
@@ -150,16 +202,12 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user in self.followers
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user in self.following
 
     def is_liked_by(self, message_to_check):
         """"Is this message liked by the user"""
@@ -171,6 +219,14 @@ class User(db.Model):
         )
 
 
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'),
+)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -199,6 +255,10 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', user_id, timestamp.desc()),
+    )
+
 
 class Like(db.Model):
     """Connection of a liked message to user."""
@@ -217,6 +277,17 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads with the message; this serves "what has this
+    # user liked" (liked page, like checks)
+    __table_args__ = (
+        db.Index(
+            'ix_likes_user_id_message_id',
+            user_id,
+            message_id,
+            unique=True,
+        ),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -1,29 +1,34 @@
 import os
-from unittest import TestCase
 
 from models import db, User, Message
+from testing import create_tables, DBTestCase, password_hash, TEST_DATABASE_URL
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['FLASK_TESTING'] = '1'
 
 
 from app import app
 
-db.drop_all()
-db.create_all()
+create_tables()
 
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DBTestCase):
+    session_options = {"expire_on_commit": False, "autoflush": False}
+
     def setUp(self):
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         self.valid_password = "password"
 
-        u1 = User.signup("u1", "u1@email.com", self.valid_password, None)
-        u2 = User.signup("u2", "u2@email.com", self.valid_password, None)
+        password = password_hash(self.valid_password)
+
+        u1 = User(username="u1", email="u1@email.com", password=password)
+        u2 = User(username="u2", email="u2@email.com", password=password)
         m1 = Message(text="This is example message")
         u1.messages.append(m1)
 
+        db.session.add_all([u1, u2])
         db.session.commit()
         self.u1_id = u1.id
         self.u2_id = u2.id
@@ -31,10 +36,6 @@ class MessageModelTestCase(TestCase):
         self.u2 = u2
         self.m1 = m1
 
-    def tearDown(self):
-        db.session.rollback()
-
-
     def test_message_model(self):
         """Test that a message is created and linked to a user"""
 
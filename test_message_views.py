@@ -6,58 +6,84 @@
 
 
 import os
-from unittest import TestCase
 
 from models import db, Message, User, Like
+from testing import (create_tables, DBTestCase, password_hash,
+                     session_cookie, TEST_DATABASE_URL, ViewTestMixin)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['FLASK_TESTING'] = '1'
 
 from app import app, CURR_USER_KEY
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+create_tables()
 
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+# even with FLASK_DEBUG on, don't stat every template on each render
+app.config['TEMPLATES_AUTO_RELOAD'] = False
 
-db.drop_all()
-db.create_all()
 
-app.config['WTF_CSRF_ENABLED'] = False
+class MessageBaseViewTestCase(ViewTestMixin, DBTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = app.test_client()
+
+        password = password_hash("password")
+
+        u1 = User(username="u1", email="u1@email.com", password=password)
+        u2 = User(username="u2", email="u2@email.com", password=password)
+        m1 = Message(text="m1-text", user=u1)
 
+        db.session.add_all([u1, u2, m1])
+        db.session.commit()
+
+        cls.u1_id = u1.id
+        cls.u2_id = u2.id
+        cls.m1_id = m1.id
+
+        cls.login_cookies = {
+            user_id: session_cookie({CURR_USER_KEY: user_id})
+            for user_id in (cls.u1_id, cls.u2_id)
+        }
 
-class MessageBaseViewTestCase(TestCase):
     def setUp(self):
-        User.query.delete()
+        with self.client.session_transaction() as sess:
+            sess.clear()
 
-        self.u1 = User.signup("u1", "u1@email.com", "password", None)
-        self.u2 = User.signup("u2", "u2@email.com", "password", None)
-        db.session.flush()
+        super().setUp()
+        self.load_fixtures()
+
+    def load_fixtures(self):
+        """Point self.u1/u2/m1 at the fixture rows in the current session."""
+
+        self.u1 = db.session.get(User, self.u1_id)
+        self.u2 = db.session.get(User, self.u2_id)
+        self.m1 = db.session.get(Message, self.m1_id)
 
-        self.m1 = Message(text="m1-text", user_id=self.u1.id)
-        db.session.add_all([self.m1])
-        db.session.commit()
 
 class MessageAddViewTestCase(MessageBaseViewTestCase):
     def test_add_message_form(self):
         """Should load add message form"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
-            resp = c.get("/messages/new")
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(3):
+                resp = c.get("/messages/new")
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Comment for messages/create.html loaded.", html)
+            self.assertInBody("Comment for messages/create.html loaded.", resp)
 
     def test_add_message(self):
         """Should be able to add messages"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
-            resp = c.post("/messages/new", data={"text": "Hello"})
+            with self.assertMaxQueries(5):
+                resp = c.post("/messages/new", data={"text": "Hello"})
 
             self.assertEqual(resp.status_code, 302)
 
@@ -66,38 +92,35 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
                                  .filter_by(text="Hello")
                                  .one_or_none())
             self.assertEqual(Message.query.count(), 2)
-            self.assertNotIn(self.m1.id, self.u2.messages)
+            self.assertNotIn(self.m1_id, self.u2.messages)
 
     def test_add_message_unauth(self):
         """Should not be able to add messages if not logged-in"""
 
-        with app.test_client() as c:
+        with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
 
-            resp = c.post("/messages/new", follow_redirects=True)
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(1):
+                resp = c.post("/messages/new", follow_redirects=True)
 
             self.assertEqual(resp.status_code, 401)
-            self.assertIn("Unauthorized", html)
+            self.assertInBody("Unauthorized", resp)
 
 class MessageDeleteViewTestCase(MessageBaseViewTestCase):
 
     def test_delete_message(self):
         """Should be able to delete messages"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
-            resp = c.post(f"/messages/{self.m1.id}/delete")
+            with self.assertMaxQueries(6):
+                resp = c.post(f"/messages/{self.m1_id}/delete")
 
             self.assertEqual(resp.status_code, 302)
 
-            self.assertIsNone(Message
-                                 .query
-                                 .filter_by(text=self.m1.text)
-                                 .one_or_none())
+            self.assertIsNone(db.session.get(Message, self.m1_id))
             self.assertEqual(Message.query.count(), 0)
 
     def test_delete_message_unauth(self):
@@ -105,169 +128,200 @@ class MessageDeleteViewTestCase(MessageBaseViewTestCase):
         Should not be able to delete message if not original poster/authorized
         """
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
-
-            resp = c.post(
-                f"/messages/{self.m1.id}/delete",
-                follow_redirects=True
-            )
+        with self.client as c:
+            self.log_in(self.u2_id)
 
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(4):
+                resp = c.post(
+                    f"/messages/{self.m1_id}/delete",
+                    follow_redirects=True
+                )
 
             self.assertEqual(resp.status_code, 401)
-            self.assertIn("Unauthorized", html)
+            self.assertInBody("Unauthorized", resp)
 
 class MessageShowViewTestCase(MessageBaseViewTestCase):
 
     def test_show_messages_with_delete_button_shown(self):
         """Should show message. Show delete button for own user's message"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
-
-            resp = c.get(
-                f"/messages/{self.m1.id}",
-                follow_redirects=True
-            )
+        with self.client as c:
+            self.log_in(self.u1_id)
 
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(4):
+                resp = c.get(
+                    f"/messages/{self.m1_id}",
+                    follow_redirects=True
+                )
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.m1.text, html)
-            self.assertIn('Delete', html)
-            self.assertIn("Comment for messages/show.html loaded.", html)
+            self.assertInBody(self.m1.text, resp)
+            self.assertInBody('Delete', resp)
+            self.assertInBody("Comment for messages/show.html loaded.", resp)
 
     def test_show_messages_without_delete_button_shown(self):
         """Should show message. Do not show delete button if not owned"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
+        with self.client as c:
+            self.log_in(self.u2_id)
+
+            with self.assertMaxQueries(6):
+                resp = c.get(
+                    f"/messages/{self.m1_id}",
+                    follow_redirects=True
+                )
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertInBody(self.m1.text, resp)
+            self.assertNotInBody('Delete', resp)
+            self.assertInBody("Comment for messages/show.html loaded.", resp)
+
+
+    def test_show_message_not_modified(self):
+        """Should send 304 if the client's copy is current, 200 once liked"""
+
+        with self.client as c:
+            self.log_in(self.u2_id)
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            etag = resp.headers["ETag"]
 
             resp = c.get(
-                f"/messages/{self.m1.id}",
-                follow_redirects=True
+                f"/messages/{self.m1_id}",
+                headers={"If-None-Match": etag},
             )
 
-            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.m1.text, html)
-            self.assertNotIn('Delete', html)
-            self.assertIn("Comment for messages/show.html loaded.", html)
+            c.post(f"/messages/{self.m1_id}/like")
 
+            resp = c.get(
+                f"/messages/{self.m1_id}",
+                headers={"If-None-Match": etag},
+            )
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertInBody("bi-star-fill", resp)
 
     def test_show_messages_unauth(self):
         """Should not show message if unauthorized"""
 
-        with app.test_client() as c:
+        with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
 
-            resp = c.get(
-                f"/messages/{self.m1.id}",
-                follow_redirects=True
-            )
-
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(2):
+                resp = c.get(
+                    f"/messages/{self.m1_id}",
+                    follow_redirects=True
+                )
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized", html)
-            self.assertNotIn("Comment for messages/show.html loaded.", html)
+            self.assertInBody("Access unauthorized", resp)
+            self.assertNotInBody("Comment for messages/show.html loaded.", resp)
 
 class MessageLikeViewTestCase(MessageBaseViewTestCase):
 
     def test_like_message(self):
         """Should be able to like a message"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
+        with self.client as c:
+            self.log_in(self.u2_id)
 
-            resp = c.post(f'/messages/{self.m1.id}/like')
+            with self.assertMaxQueries(5):
+                resp = c.post(f'/messages/{self.m1_id}/like')
 
             self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f'/messages/{self.m1.id}')
+            self.assertEqual(resp.location, f'/messages/{self.m1_id}')
 
             self.assertIn(self.m1, self.u2.messages_liked)
 
             self.assertIsNotNone(Like
                                  .query
-                                 .filter_by(message_id=self.m1.id)
+                                 .filter_by(message_id=self.m1_id)
                                  .one_or_none())
             self.assertEqual(Like.query.count(), 1)
             self.assertEqual(len(self.u2.messages_liked), 1)
             self.assertEqual(len(self.m1.liking_users), 1)
 
             resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
 
-            self.assertIn("bi-star-fill", html)
+            self.assertInBody("bi-star-fill", resp)
+
+    def test_like_message_again(self):
+        """Should have no change if try to like a message twice"""
+
+        self.u2.messages_liked.append(self.m1)
+        db.session.commit()
+
+        with self.client as c:
+            self.log_in(self.u2_id)
+
+            resp = c.post(f'/messages/{self.m1_id}/like')
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Like.query.count(), 1)
+            self.assertIn(self.m1, self.u2.messages_liked)
 
     def test_like_message_self(self):
         """Should not be able to like own message"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
-            resp = c.post(f'/messages/{self.m1.id}/like')
+            with self.assertMaxQueries(4):
+                resp = c.post(f'/messages/{self.m1_id}/like')
 
             self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f'/messages/{self.m1.id}')
+            self.assertEqual(resp.location, f'/messages/{self.m1_id}')
 
             self.assertNotIn(self.m1, self.u1.messages_liked)
 
             self.assertIsNone(Like
                                  .query
-                                 .filter_by(message_id=self.m1.id)
+                                 .filter_by(message_id=self.m1_id)
                                  .one_or_none())
             self.assertEqual(Like.query.count(), 0)
             self.assertNotEqual(len(self.u1.messages_liked), 1)
             self.assertNotEqual(len(self.m1.liking_users), 1)
 
             resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
 
-            self.assertIn("You cannot like your own Warble!", html)
-            self.assertNotIn("bi-star-fill", html)
+            self.assertInBody("You cannot like your own Warble!", resp)
+            self.assertNotInBody("bi-star-fill", resp)
 
     def test_like_messages_unauth(self):
         """Should not be able to like if unauthorized"""
 
-        with app.test_client() as c:
+        with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
 
-            resp = c.post(f'/messages/{self.m1.id}/like', follow_redirects=True)
-
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(1):
+                resp = c.post(f'/messages/{self.m1_id}/like', follow_redirects=True)
 
             self.assertEqual(resp.status_code, 401)
-            self.assertIn("Unauthorized", html)
-            self.assertNotIn("bi-star", html)
+            self.assertInBody("Unauthorized", resp)
+            self.assertNotInBody("bi-star", resp)
             self.assertNotEqual(len(self.m1.liking_users), 1)
 
     def test_show_liked_messages(self):
         """Should show a user's liked messages"""
 
-        self.u2.messages_liked.append(self.m1)
-        db.session.commit()
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.flush()
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
+        with self.client as c:
+            self.log_in(self.u2_id)
 
-            resp = c.get(f'/users/{self.u2.id}/messages/liked')
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(7):
+                resp = c.get(f'/users/{self.u2_id}/messages/liked')
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.u1.username, html)
-            self.assertIn(self.m1.text, html)
-            self.assertIn('Comment for users/liked.html loaded', html)
+            self.assertInBody(self.u1.username, resp)
+            self.assertInBody(self.m1.text, resp)
+            self.assertInBody('Comment for users/liked.html loaded', resp)
 
 
     def test_show_liked_messages_unauth(self):
@@ -276,21 +330,20 @@ class MessageLikeViewTestCase(MessageBaseViewTestCase):
         self.u2.messages_liked.append(self.m1)
         db.session.commit()
 
-        with app.test_client() as c:
+        with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
 
-            resp = c.get(
-                f'/users/{self.u2.id}/messages/liked',
-                follow_redirects=True
-            )
-
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(2):
+                resp = c.get(
+                    f'/users/{self.u2_id}/messages/liked',
+                    follow_redirects=True
+                )
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized", html)
-            self.assertNotIn(self.m1.text, html)
-            self.assertNotIn('Comment for users/liked.html loaded', html)
+            self.assertInBody("Access unauthorized", resp)
+            self.assertNotInBody(self.m1.text, resp)
+            self.assertNotInBody('Comment for users/liked.html loaded', resp)
 
 class MessageUnlikeViewTestCase(MessageBaseViewTestCase):
 
@@ -300,44 +353,41 @@ class MessageUnlikeViewTestCase(MessageBaseViewTestCase):
         self.u2.messages_liked.append(self.m1)
         db.session.commit()
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
+        with self.client as c:
+            self.log_in(self.u2_id)
 
-            resp = c.post(f'/messages/{self.m1.id}/unlike')
+            with self.assertMaxQueries(5):
+                resp = c.post(f'/messages/{self.m1_id}/unlike')
 
             self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f'/messages/{self.m1.id}')
+            self.assertEqual(resp.location, f'/messages/{self.m1_id}')
 
             self.assertNotIn(self.m1, self.u2.messages_liked)
 
             self.assertIsNone(Like
                                  .query
-                                 .filter_by(message_id=self.m1.id)
+                                 .filter_by(message_id=self.m1_id)
                                  .one_or_none())
             self.assertNotEqual(Like.query.count(), 1)
             self.assertNotEqual(len(self.u2.messages_liked), 1)
             self.assertNotEqual(len(self.m1.liking_users), 1)
 
             resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
 
-            self.assertNotIn("bi-star-fill", html)
+            self.assertNotInBody("bi-star-fill", resp)
 
     def test_unlike_messages_not_liked(self):
         """Should stay unliked if unliked"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
-
-            resp = c.post(
-                f'/messages/{self.m1.id}/unlike',
-                follow_redirects=True
-            )
+        with self.client as c:
+            self.log_in(self.u2_id)
 
-            html = resp.get_data(as_text=True)
+            with self.assertMaxQueries(8):
+                resp = c.post(
+                    f'/messages/{self.m1_id}/unlike',
+                    follow_redirects=True
+                )
 
             self.assertEqual(resp.status_code, 200)
-            self.assertNotIn("bi-star-fill", html)
+            self.assertNotInBody("bi-star-fill", resp)
             self.assertNotEqual(self.u2.messages_liked, 1)
\ No newline at end of file
@@ -6,40 +6,62 @@
 
 
 import os
-from unittest import TestCase
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import raiseload, selectinload
 
-from models import db, User, Message
+from models import db, User, UsernameTakenError
+from testing import create_tables, DBTestCase, password_hash, TEST_DATABASE_URL
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['FLASK_TESTING'] = '1'
 
 from app import app
 
-db.drop_all()
-db.create_all()
+create_tables()
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DBTestCase):
+    session_options = {"expire_on_commit": False, "autoflush": False}
+
     def setUp(self):
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         self.valid_password = "password"
 
-        u1 = User.signup("u1", "u1@email.com", self.valid_password, None)
-        u2 = User.signup("u2", "u2@email.com", self.valid_password, None)
+        password = password_hash(self.valid_password)
+
+        u1 = User(username="u1", email="u1@email.com", password=password)
+        u2 = User(username="u2", email="u2@email.com", password=password)
 
+        db.session.add_all([u1, u2])
         db.session.commit()
         self.u1_id = u1.id
         self.u2_id = u2.id
         self.u1 = u1
         self.u2 = u2
 
-    def tearDown(self):
-        db.session.rollback()
+    def load_user(self, user_id):
+        """Fetch a user with its follows and messages loaded up front.
+
+        Any other relationship access raises, so a test that starts relying
+        on a lazy load (one query per access) fails instead.
+        """
+
+        return db.session.execute(
+            select(User)
+            .where(User.id == user_id)
+            .options(
+                selectinload(User.followers),
+                selectinload(User.following),
+                selectinload(User.messages),
+                raiseload('*'),
+            )
+        ).scalar_one()
 
     def test_user_model(self):
-        u1 = User.query.get(self.u1_id)
+        u1 = self.load_user(self.u1_id)
 
         # User should have no messages & no followers
         self.assertEqual(len(u1.messages), 0)
@@ -50,49 +72,58 @@ class UserModelTestCase(TestCase):
         self.u1.following.append(self.u2)
         db.session.commit()
 
-        self.assertTrue(self.u1.is_following(self.u2))
-        self.assertFalse(self.u2.is_following(self.u1))
+        u1 = self.load_user(self.u1_id)
+        u2 = self.load_user(self.u2_id)
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u2.is_following(u1))
 
     def test_is_followed_by(self):
 
         self.u1.followers.append(self.u2)
         db.session.commit()
 
-        self.assertTrue(self.u1.is_followed_by(self.u2))
-        self.assertFalse(self.u2.is_followed_by(self.u1))
+        u1 = self.load_user(self.u1_id)
+        u2 = self.load_user(self.u2_id)
+
+        self.assertTrue(u1.is_followed_by(u2))
+        self.assertFalse(u2.is_followed_by(u1))
 
     def test_valid_signup(self):
 
         u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
 
-        self.assertIsNotNone(User
-                             .query
-                             .filter_by(username=u3.username)
-                             .one_or_none())
+        self.assertIsNotNone(db.session.get(User, u3.id))
 
     def test_invalid_signup_username(self):
         """Should not allow sign up for taken username"""
 
-        try:
-            u4 = User.signup(self.u1.username, "u4@gmail.com","password",None)
-            db.session.commit()
-
-        except IntegrityError:
-            u4 = 'username already taken'
-
-        self.assertEqual(u4, 'username already taken')
+        with self.assertRaises(UsernameTakenError):
+            User.signup(self.u1.username, "u4@gmail.com", "password", None)
 
     def test_invalid_signup_email(self):
         """Should not allow sign up for taken email"""
 
-        try:
-            u4 = User.signup('u4', self.u1.email,"password",None)
-            db.session.commit()
+        with self.assertRaises(UsernameTakenError):
+            User.signup('u4', self.u1.email, "password", None)
+
+    def test_invalid_signup_empty_password(self):
+        """Should not report other bad input as a taken username/email"""
+
+        with self.assertRaises(ValueError) as cm:
+            User.signup('u4', "u4@gmail.com", "", None)
 
-        except IntegrityError:
-            u4 = 'email already taken'
+        self.assertNotIsInstance(cm.exception, UsernameTakenError)
 
-        self.assertEqual(u4, 'email already taken')
+    def test_invalid_signup_pending_duplicate(self):
+        """Should still hit the unique constraint for unflushed duplicates"""
+
+        User.signup('u4', "u4@gmail.com", "password", None)
+        User.signup('u4', "u4@gmail.com", "password", None)
+
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
 
     def test_auth_ok(self):
         """Should authenticate and return user for valid creds"""
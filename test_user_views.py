@@ -1,70 +1,145 @@
-"""Message View tests."""
+"""User View tests."""
 
 # run these tests like:
 #
-#    FLASK_DEBUG=False python -m unittest test_message_views.py
+#    FLASK_DEBUG=False python -m unittest test_user_views.py
 
 
 import os
 from flask import session
-from unittest import TestCase
+from sqlalchemy import delete, insert, select
 
-from models import db, Message, User
+from models import db, Follow, Message, User
+from testing import (create_tables, DBTestCase, password_hash,
+                     session_cookie, TEST_DATABASE_URL, ViewTestMixin)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+os.environ['FLASK_TESTING'] = '1'
 
 from app import app, CURR_USER_KEY
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+create_tables()
 
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+# even with FLASK_DEBUG on, don't stat every template on each render
+app.config['TEMPLATES_AUTO_RELOAD'] = False
 
-db.drop_all()
-db.create_all()
+VALID_PASSWORD = "password"
 
-app.config['WTF_CSRF_ENABLED'] = False
 
+class UserBaseViewTestCase(ViewTestMixin, DBTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client = app.test_client()
+
+        cls.valid_password = VALID_PASSWORD
+        password = password_hash(cls.valid_password)
+
+        result = db.session.execute(
+            User.__table__.insert().returning(
+                User.id, sort_by_parameter_order=True),
+            [
+                {"username": "u1", "email": "u1@email.com",
+                 "password": password},
+                {"username": "u2", "email": "u2@email.com",
+                 "password": password},
+            ],
+        )
+        cls.u1_id, cls.u2_id = result.scalars().all()
+
+        db.session.commit()
+
+        cls.login_cookies = {
+            user_id: session_cookie({CURR_USER_KEY: user_id})
+            for user_id in (cls.u1_id, cls.u2_id)
+        }
 
-class UserBaseViewTestCase(TestCase):
     def setUp(self):
-        User.query.delete()
+        with self.client.session_transaction() as sess:
+            sess.clear()
 
-        self.valid_password = "password"
+        super().setUp()
 
-        self.u1 = User.signup("u1", "u1@email.com", self.valid_password, None)
-        self.u2 = User.signup("u2", "u2@email.com", self.valid_password, None)
+        self.u1 = db.session.get(User, self.u1_id)
+        self.u2 = db.session.get(User, self.u2_id)
 
-        db.session.commit()
+    def add_follow(self, follower_id, followed_id):
+        """Have one user follow another, straight into the follows table.
+
+        Skips loading either user's collections; the row is visible to
+        requests made later in the test, which share this session.
+        """
+
+        db.session.execute(insert(Follow).values(
+            user_following_id=follower_id,
+            user_being_followed_id=followed_id,
+        ))
 
-    def tearDown(self):
-        """Rollback any fouled transactions"""
+    def following_ids(self, user_id):
+        """Ids of the users this user follows, read from the follows table."""
+
+        return set(db.session.execute(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == user_id)
+        ).scalars())
 
-        db.session.rollback()
 
 class UserHomeRedirectTestCase(UserBaseViewTestCase):
 
     def test_homepage_redirect_loggedin(self):
         """Should redirect to home if logged in."""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.get('/')
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for home.html loaded.', html)
+            self.assertInBody('Comment for home.html loaded.', resp)
 
     def test_homepage_redirect_anon(self):
         """Should redirect to home anon if not logged in."""
 
-        with app.test_client() as c:
+        with self.client as c:
             resp = c.get('/')
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for home-anon.html loaded.', html)
+            self.assertInBody('Comment for home-anon.html loaded.', resp)
+
+    def test_homepage_anon_public_cache(self):
+        """Should let shared caches keep the anon homepage, keyed on cookie"""
+
+        with self.client as c:
+            resp = c.get('/')
+
+            self.assertTrue(resp.cache_control.public)
+            self.assertEqual(resp.cache_control.max_age, 60)
+            self.assertIn('Cookie', resp.vary)
+
+            resp = c.get('/', headers={'If-None-Match': resp.headers['ETag']})
+
+            self.assertEqual(resp.status_code, 304)
+
+    def test_homepage_anon_flash_not_cached(self):
+        """Should not publicly cache an anon homepage showing a flash"""
+
+        with self.client as c:
+            resp = c.get(f'/users/{self.u1.id}', follow_redirects=True)
+
+            self.assertInBody("Access unauthorized.", resp)
+            self.assertFalse(resp.cache_control.public)
+
+    def test_homepage_loggedin_not_cached(self):
+        """Should never store the logged-in homepage"""
+
+        with self.client as c:
+            self.log_in(self.u1_id)
+
+            resp = c.get('/')
+
+            self.assertTrue(resp.cache_control.no_store)
 
 
 class UserAddViewTestCase(UserBaseViewTestCase):
@@ -72,30 +147,41 @@ class UserAddViewTestCase(UserBaseViewTestCase):
     def test_signup_form(self):
         """Should load signup form"""
 
-        with app.test_client() as c:
+        with self.client as c:
+            resp = c.get("/signup")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertInBody('Comment for users/signup.html loaded.', resp)
+
+    def test_signup_form_anon_session_unmodified(self):
+        """Logging out and setting up g shouldn't touch an anonymous session
+
+        CSRF is off in these tests; with it on, the signup form's own
+        csrf_token still writes the session.
+        """
+
+        with self.client as c:
             resp = c.get("/signup")
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for users/signup.html loaded.', html)
+            self.assertFalse(session.modified)
+            self.assertNotIn(CURR_USER_KEY, session)
 
     def test_signup_form_logged_in(self):
         """Should log you out if you load signup form while logged in"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
             resp = c.get("/signup")
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for users/signup.html loaded.', html)
+            self.assertInBody('Comment for users/signup.html loaded.', resp)
             self.assertEqual(session.get(CURR_USER_KEY), None)
 
     def test_signup_submit_ok(self):
         """Should sign up user and redirect to home"""
 
-        with app.test_client() as c:
+        with self.client as c:
             resp = c.post(
                 "/signup",
                 data={
@@ -109,15 +195,14 @@ class UserAddViewTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "/")
 
-            self.assertIsNotNone(User
-                                 .query
-                                 .filter_by(username="test")
-                                 .one_or_none())
+            self.assertIsNotNone(db.session.execute(
+                select(User.id).where(User.username == "test")
+            ).scalar_one_or_none())
 
     def test_signup_submit_fail(self):
         """Should redirect back to form if username or email taken"""
 
-        with app.test_client() as c:
+        with self.client as c:
             resp = c.post(
                 "/signup",
                 data={
@@ -128,11 +213,10 @@ class UserAddViewTestCase(UserBaseViewTestCase):
                     },
                 follow_redirects=True,
             )
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for users/signup.html loaded.', html)
-            self.assertIn("Username or email already taken", html)
+            self.assertInBody('Comment for users/signup.html loaded.', resp)
+            self.assertInBody("Username or email already taken", resp)
 
 
 class UserLoginViewTestCase(UserBaseViewTestCase):
@@ -140,17 +224,16 @@ class UserLoginViewTestCase(UserBaseViewTestCase):
     def test_login_form(self):
         """Should load login form"""
 
-        with app.test_client() as c:
+        with self.client as c:
             resp = c.get("/login")
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for users/login.html loaded.', html)
+            self.assertInBody('Comment for users/login.html loaded.', resp)
 
     def test_login_ok(self):
         """Should sign up user and redirect to home"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.post(
                 "/login",
                 data={
@@ -165,7 +248,7 @@ class UserLoginViewTestCase(UserBaseViewTestCase):
     def test_login_bad(self):
         """Should redirect back to form if username or email taken"""
 
-        with app.test_client() as client:
+        with self.client as client:
             resp = client.post(
                 "/login",
                 data={
@@ -173,35 +256,22 @@ class UserLoginViewTestCase(UserBaseViewTestCase):
                     "password": "wrong-wrong",
                 }
             )
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Invalid credentials", html)
+            self.assertInBody("Invalid credentials", resp)
             self.assertEqual(session.get(CURR_USER_KEY), None)
 
     def test_logout(self):
         """Should log out user and redirect to homepage"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
-            resp = c.post(
-                "/logout"
-            )
+        with self.client as c:
+            self.log_in(self.u1_id)
+            resp = c.post("/logout")
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "/")
             self.assertEqual(session.get(CURR_USER_KEY), None)
-
-            resp = c.get(
-                resp.location,
-                follow_redirects=True,
-            )
-
-            html = resp.get_data(as_text=True)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn('User logged out!', html)
+            self.assertFlashed('User logged out!')
 
 
 class UserListViewTestCase(UserBaseViewTestCase):
@@ -209,41 +279,66 @@ class UserListViewTestCase(UserBaseViewTestCase):
     def test_list_users(self):
         """Should list warbler users if logged-in"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
             resp = c.get('/users')
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Comment for users/index.html loaded.", html)
+            self.assertInBody("Comment for users/index.html loaded.", resp)
             self.assertEqual(session.get(CURR_USER_KEY), self.u1.id)
 
     def test_list_users_search_found(self):
         """Should find a searched for user"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.get(f'/users?q={self.u2.username}')
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.u2.username, html)
+            self.assertInBody(self.u2.username, resp)
+
+    def test_list_users_search_case_insensitive(self):
+        """Should find a user regardless of the search term's case"""
+
+        with self.client as c:
+            self.log_in(self.u1_id)
+
+            resp = c.get(f'/users?q={self.u2.username.upper()}')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertInBody(f"@{self.u2.username}", resp)
+
+    def test_list_users_search_ordered(self):
+        """Should list search matches by username"""
+
+        db.session.add_all([
+            User(username="zeta-match", email="z@email.com", password="x"),
+            User(username="alpha-match", email="a@email.com", password="x"),
+        ])
+        db.session.flush()
+
+        with self.client as c:
+            self.log_in(self.u1_id)
+
+            resp = c.get('/users?q=match')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(
+                resp.data.index(b"@alpha-match"),
+                resp.data.index(b"@zeta-match"),
+            )
 
     def test_list_users_search_not_found(self):
         """Should not find user with search criteria that doesn't match"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.get(f'/users?q={self.u1.username}')
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertNotIn(self.u2.username, html)
+            self.assertNotInBody(self.u2.username, resp)
 
 
 class UserProfileViewTestCase(UserBaseViewTestCase):
@@ -251,22 +346,74 @@ class UserProfileViewTestCase(UserBaseViewTestCase):
     def test_show_user(self):
         """Should show data about a user if logged in"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
             resp = c.get(
                 f"/users/{self.u2.id}",
             )
 
-            html = resp.get_data(as_text=True)
+            self.assertInBody("Comment for users/show.html loaded.", resp)
+            self.assertInBody(self.u2.username, resp)
+
+    def test_show_user_not_modified(self):
+        """Should send 304 if the client's copy is current, 200 once followed"""
+
+        with self.client as c:
+            self.log_in(self.u1_id)
+
+            resp = c.get(f"/users/{self.u2.id}")
+            etag = resp.headers["ETag"]
+
+            resp = c.get(f"/users/{self.u2.id}", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            c.post(f"/users/follow/{self.u2.id}")
+
+            resp = c.get(f"/users/{self.u2.id}", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertInBody("Unfollow", resp)
+
+    def test_show_user_new_session_not_reused(self):
+        """Should re-render for a new session, whose CSRF tokens differ"""
+
+        with self.client as c:
+            self.log_in(self.u1_id)
+            with c.session_transaction() as sess:
+                sess["csrf_token"] = "old-session-token"
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers["ETag"]
+
+            with c.session_transaction() as sess:
+                sess["csrf_token"] = "new-session-token"
+
+            resp = c.get(f"/users/{self.u2_id}", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_show_user_csrf_no_time_limit(self):
+        """Should still tag the page when CSRF tokens never expire"""
+
+        app.config['WTF_CSRF_TIME_LIMIT'] = None
+        self.addCleanup(app.config.pop, 'WTF_CSRF_TIME_LIMIT', None)
 
-            self.assertIn("Comment for users/show.html loaded.", html)
-            self.assertIn(self.u2.username, html)
+        with self.client as c:
+            self.log_in(self.u1_id)
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag = resp.headers["ETag"]
+
+            resp = c.get(f"/users/{self.u2_id}", headers={"If-None-Match": etag})
+
+            self.assertEqual(resp.status_code, 304)
 
     def test_show_user_unauth(self):
         """Should not allow unauth user"""
 
-        with app.test_client() as client:
+        with self.client as client:
             with client.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
             resp = client.get(
@@ -275,25 +422,15 @@ class UserProfileViewTestCase(UserBaseViewTestCase):
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "/")
-
-            resp = client.get(
-                resp.location,
-                follow_redirects=True,
-            )
-
-            html = resp.get_data(as_text=True)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn("Access unauthorized.", html)
+            self.assertFlashed("Access unauthorized.")
 
 class UserDeleteViewTestCase(UserBaseViewTestCase):
 
     def test_delete_user(self):
         """Should be able to delete user"""
 
-        with app.test_client() as client:
-            with client.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as client:
+            self.log_in(self.u1_id)
 
             resp = client.post(
                 "/users/delete",
@@ -302,17 +439,33 @@ class UserDeleteViewTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "/signup")
             self.assertEqual(session.get(CURR_USER_KEY), None)
+            self.assertFlashed("Deleted u1!")
 
-            resp = client.get(resp.location)
-            html = resp.get_data(as_text=True)
+    def test_delete_user_with_messages_and_follows(self):
+        """Should remove the user's messages and follows along with them"""
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(f"Deleted {self.u1.username}!", html)
+        self.u1.messages.append(Message(text="u1 message"))
+        self.u1.following.append(self.u2)
+        self.u2.following.append(self.u1)
+        db.session.commit()
+
+        u1_id = self.u1.id
+
+        with self.client as client:
+            self.log_in(u1_id)
+
+            resp = client.post("/users/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIsNone(db.session.get(User, u1_id))
+            self.assertEqual(Message.query.filter_by(user_id=u1_id).count(), 0)
+            self.assertEqual(len(self.u2.following), 0)
+            self.assertEqual(len(self.u2.followers), 0)
 
     def test_delete_user_unauth(self):
         """Should not be able to delete a user if unauthorized/not that user"""
 
-        with app.test_client() as c:
+        with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
 
@@ -320,9 +473,7 @@ class UserDeleteViewTestCase(UserBaseViewTestCase):
                 "/users/delete"
             )
 
-            html = resp.get_data(as_text=True)
-
-            self.assertIn("Unauthorized",html)
+            self.assertInBody("Unauthorized",resp)
             self.assertEqual(resp.status_code,401)
 
 class UserUpdateViewTestCase(UserBaseViewTestCase):
@@ -330,33 +481,42 @@ class UserUpdateViewTestCase(UserBaseViewTestCase):
     def test_update_profile_form(self):
         """Should load update profile form"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
             resp = c.get("/users/profile")
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('Comment for users/edit.html loaded.', html)
+            self.assertInBody('Comment for users/edit.html loaded.', resp)
+
+    def test_update_profile_form_queries(self):
+        """Should load the edit form without fetching the password hash"""
+
+        with self.client as c:
+            self.log_in(self.u1_id)
+
+            # the user, their following and followers, then their email
+            with self.assertMaxQueries(4):
+                resp = c.get("/users/profile")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertInBody('value="u1@email.com"', resp)
 
     def test_update_profile_form_unauth(self):
         "Should not load update profile if not logged in"
 
-        with app.test_client() as c:
+        with self.client as c:
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = None
             resp = c.get("/users/profile")
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 401)
-            self.assertNotIn('Comment for users/edit.html loaded.', html)
+            self.assertNotInBody('Comment for users/edit.html loaded.', resp)
 
     def test_update_profile_ok(self):
         """Should be able to make updates to a user"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.post(
                 "/users/profile",
@@ -376,22 +536,20 @@ class UserUpdateViewTestCase(UserBaseViewTestCase):
             self.assertEqual(session.get(CURR_USER_KEY), self.u1.id)
 
             resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn(f"Updated {self.u1.username}!", html)
-            self.assertIn('bob is my new username', html)
+            self.assertInBody(f"Updated {self.u1.username}!", resp)
+            self.assertInBody('bob is my new username', resp)
 
-            self.assertIn("Comment for users/show.html loaded.", html)
+            self.assertInBody("Comment for users/show.html loaded.", resp)
 
     def test_update_profile_bad(self):
         """
         Should not be able to make updates if username/email match other users
         """
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u2.id
+        with self.client as c:
+            self.log_in(self.u2_id)
 
             resp = c.post(
                 "/users/profile",
@@ -406,13 +564,11 @@ class UserUpdateViewTestCase(UserBaseViewTestCase):
                     }
             )
 
-            html = resp.get_data(as_text=True)
-
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Comment for users/edit.html loaded.", html)
+            self.assertInBody("Comment for users/edit.html loaded.", resp)
 
-            self.assertIn("Username already taken", html)
-            self.assertIn("Email already taken", html)
+            self.assertInBody("Username already taken", resp)
+            self.assertInBody("Email already taken", resp)
             self.assertEqual(session.get(CURR_USER_KEY), self.u2.id)
 
     def test_update_profile_bad_pwd(self):
@@ -420,9 +576,8 @@ class UserUpdateViewTestCase(UserBaseViewTestCase):
         Should not be able to make updates if wrong password
         """
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.post(
                 "/users/profile",
@@ -437,140 +592,80 @@ class UserUpdateViewTestCase(UserBaseViewTestCase):
                     }
             )
 
-            html = resp.get_data(as_text=True)
-
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("Comment for users/edit.html loaded.", html)
+            self.assertInBody("Comment for users/edit.html loaded.", resp)
 
-            self.assertIn("Incorrect password", html)
+            self.assertInBody("Incorrect password", resp)
             self.assertEqual(session.get(CURR_USER_KEY), self.u1.id)
 
 class UserFollowViewTestCase(UserBaseViewTestCase):
 
-    def test_follow_user(self):
-        """Should be able to follow a user"""
+    def test_follow_and_stop_following(self):
+        """Should follow/stop following once, with no change on repeats"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        cases = [
+            # (following before, route, following after)
+            (False, "follow", True),
+            (True, "follow", True),
+            (True, "stop-following", False),
+            (False, "stop-following", False),
+        ]
 
-            resp = c.post(f'/users/follow/{self.u2.id}')
+        with self.client as c:
+            self.log_in(self.u1_id)
 
-            self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f"/users/{self.u1.id}/following")
+            for before, route, after in cases:
+                with self.subTest(following_before=before, route=route):
+                    db.session.execute(delete(Follow))
+                    if before:
+                        self.add_follow(self.u1_id, self.u2_id)
+                    db.session.expire_all()
 
-            resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
+                    resp = c.post(f'/users/{route}/{self.u2_id}')
 
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.u2.username, html)
+                    self.assertEqual(resp.status_code, 302)
+                    self.assertEqual(
+                        resp.location, f"/users/{self.u1_id}/following")
+
+                    resp = c.get(resp.location)
 
-            self.assertIn(self.u2, self.u1.following)
-            self.assertEqual(len(self.u1.following), 1)
+                    self.assertEqual(resp.status_code, 200)
+                    if after:
+                        self.assertInBody(self.u2.username, resp)
+                    else:
+                        self.assertNotInBody(self.u2.username, resp)
+
+                    self.assertEqual(
+                        self.following_ids(self.u1_id),
+                        {self.u2_id} if after else set(),
+                    )
 
     def test_unable_to_follow_self(self):
         """Should not be able to follow own user"""
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.post(
                 f'/users/follow/{self.u1.id}',
                 follow_redirects=True
             )
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn("You cannot follow yourself!", html)
-            self.assertNotIn(self.u1, self.u1.following)
-            self.assertNotIn(self.u1, self.u1.followers)
-
-    def test_follow_user_again(self):
-        """Should have no change if try to follow a user twice"""
-
-        self.u1.following.append(self.u2)
-        db.session.commit()
-
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
-
-            resp = c.post(f'/users/follow/{self.u2.id}')
-
-            self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f"/users/{self.u1.id}/following")
-
-            resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.u2.username, html)
-
-            self.assertIn(self.u2, self.u1.following)
-            self.assertEqual(len(self.u1.following), 1)
-
-
-    def test_stop_following_user(self):
-        """Should be able to stop following a user"""
-
-        self.u1.following.append(self.u2)
-        db.session.commit()
-
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
-
-            resp = c.post(f'/users/stop-following/{self.u2.id}')
-
-            self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f"/users/{self.u1.id}/following")
-
-            resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertNotIn(self.u2.username, html)
-
-            self.assertNotIn(self.u2, self.u1.following)
-            self.assertEqual(len(self.u1.following), 0)
-
-    def test_stop_following_user_again(self):
-        """Should be able to stop following a user twice and have no change"""
-
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
-
-            resp = c.post(f'/users/stop-following/{self.u2.id}')
-
-            self.assertEqual(resp.status_code, 302)
-            self.assertEqual(resp.location, f"/users/{self.u1.id}/following")
-
-            resp = c.get(resp.location)
-            html = resp.get_data(as_text=True)
-
-            self.assertEqual(resp.status_code, 200)
-            self.assertNotIn(self.u2.username, html)
-
-            self.assertNotIn(self.u2, self.u1.following)
-            self.assertEqual(len(self.u1.following), 0)
-
+            self.assertInBody("You cannot follow yourself!", resp)
+            self.assertNotIn(self.u1_id, self.following_ids(self.u1_id))
 
     def test_show_followers(self):
         """Should show a user's followers"""
 
-        self.u1.followers.append(self.u2)
-        db.session.commit()
+        self.add_follow(self.u2.id, self.u1.id)
 
-        with app.test_client() as c:
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.u1.id
+        with self.client as c:
+            self.log_in(self.u1_id)
 
             resp = c.get(f'/users/{self.u1.id}/followers')
-            html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn(self.u2.username, html)
+            self.assertInBody(self.u2.username, resp)
 
-            self.assertIn('Comment for users/followers.html loaded', html)
\ No newline at end of file
+            self.assertInBody('Comment for users/followers.html loaded', resp)
\ No newline at end of file
@@ -0,0 +1,254 @@
+"""Shared helpers for the Warbler test suite.
+
+Run the whole suite in one process, importing the app once, with:
+
+    python -m unittest discover -t . -p 'test_*.py' --buffer
+
+(or `pytest`, which collects the same files).
+"""
+
+import functools
+import os
+import re
+from contextlib import contextmanager
+from unittest import TestCase
+
+from flask import current_app
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from models import bcrypt, db, User
+
+# Point TEST_DATABASE_URL at a throwaway cluster to speed the suite up; the
+# data is disposable, so that cluster can run with durability off, e.g.
+#
+#    pg_ctl -D /dev/shm/warbler-pg -o "-c fsync=off -c synchronous_commit=off
+#        -c full_page_writes=off -k /dev/shm" start
+#    TEST_DATABASE_URL=postgresql:///warbler_test?host=/dev/shm \
+#        python -m unittest
+TEST_DATABASE_URL = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler_test")
+
+# Under `pytest -n` (pytest-xdist) each worker gets its own database, e.g.
+# warbler_test_gw0: a class's fixtures stay in an open transaction, so
+# workers sharing one database would block on each other's unique rows.
+XDIST_WORKER = os.environ.get('PYTEST_XDIST_WORKER')
+if XDIST_WORKER:
+    _url = make_url(TEST_DATABASE_URL)
+    TEST_DATABASE_URL = _url.set(
+        database=f"{_url.database}_{XDIST_WORKER}",
+    ).render_as_string(hide_password=False)
+
+# Fixtures sign up the same few passwords over and over; hash each one once
+# per run. Salts repeat across users, which only the tests ever see.
+bcrypt.generate_password_hash = functools.lru_cache(
+    bcrypt.generate_password_hash)
+
+SAVEPOINT_STATEMENT = re.compile(r"(RELEASE |ROLLBACK TO )?SAVEPOINT ")
+
+
+def password_hash(password):
+    """Hash `password` the way User.signup does, for building users directly.
+
+    Fixtures that just need users to exist can add User rows in one flush
+    instead of going through signup's checks one user at a time.
+    """
+
+    return bcrypt.generate_password_hash(
+        password,
+        rounds=current_app.config['BCRYPT_LOG_ROUNDS'],
+    ).decode('UTF-8')
+
+
+def session_cookie(data):
+    """Sign `data` as a session cookie value for the test client.
+
+    Sign once per class and hand the value to client.set_cookie(), rather
+    than opening a session_transaction (load, modify, re-sign) per test.
+    """
+
+    serializer = current_app.session_interface.get_signing_serializer(
+        current_app)
+    return serializer.dumps(data)
+
+
+def create_tables():
+    """Create the schema in the test database unless it's already there.
+
+    DBTestCase never lets rows reach the database, so an existing schema can
+    be reused across runs instead of being dropped and rebuilt. After
+    changing the models, drop the test database's tables (or recreate the
+    database) so they pick up the change.
+
+    An xdist worker's database is created first if it doesn't exist yet.
+    """
+
+    if XDIST_WORKER:
+        create_worker_database()
+
+    if not inspect(db.engine).has_table(User.__tablename__):
+        db.create_all()
+
+
+def create_worker_database():
+    """Create this xdist worker's test database if it's missing."""
+
+    url = db.engine.url
+    server = create_engine(
+        url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+
+    with server.connect() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": url.database},
+        ).scalar()
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+
+    server.dispose()
+
+
+class DBTestCase(TestCase):
+    """TestCase whose database changes are all rolled back.
+
+    Each class gets its own connection with an open transaction, and
+    db.session is swapped for one that joins it using SAVEPOINTs. Commits
+    (in the test or in views) behave normally for the code under test but
+    never reach the database.
+
+    Rows created in setUpClass (after calling super) live for the whole
+    class; keep their ids rather than the objects, since each test gets a
+    fresh session. Each test runs inside its own SAVEPOINT, which tearDown
+    rolls back, so tests can't see each other's changes.
+
+    Extra sessionmaker arguments for the test session go in
+    `session_options`. Model tests can use {"expire_on_commit": False} to
+    skip reloading their fixtures after each commit; view tests shouldn't,
+    because the views share this session and write through Core statements
+    the ORM doesn't see.
+    """
+
+    session_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = db.engine.connect()
+        cls.transaction = cls.connection.begin()
+
+        cls.app_session = db.session
+        db.session = scoped_session(sessionmaker(
+            bind=cls.connection,
+            join_transaction_mode="create_savepoint",
+            **cls.session_options,
+        ))
+        # Class cleanups run even when a subclass's setUpClass fails after
+        # calling super(), which tearDownClass would not.
+        cls.addClassCleanup(cls._restore_session)
+
+    @classmethod
+    def _restore_session(cls):
+        db.session.remove()
+        db.session = cls.app_session
+
+        cls.transaction.rollback()
+        cls.connection.close()
+
+    def setUp(self):
+        db.session.remove()
+        self.savepoint = self.connection.begin_nested()
+
+    def tearDown(self):
+        db.session.remove()
+        self.savepoint.rollback()
+
+
+class ViewTestMixin:
+    """Helpers for TestCases that drive the app through `self.client`.
+
+    Expects `self.login_cookies`, mapping user ids to session cookies made
+    with session_cookie().
+    """
+
+    def load_fixtures(self):
+        """Reload any fixture objects the test holds; nothing by default."""
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        """Fail if the block runs more than `n` SQL queries.
+
+        The session is flushed and emptied first so the request starts cold,
+        as it does in production: nothing the test loaded (the fixtures
+        included) can answer the view's queries from the identity map.
+        The fixtures are loaded again afterwards, via load_fixtures().
+        """
+
+        db.session.flush()
+        db.session.expunge_all()
+
+        with count_queries() as queries:
+            yield
+
+        self.load_fixtures()
+        self.assertLessEqual(len(queries), n, "\n".join(queries))
+
+    def log_in(self, user_id):
+        """Log the test client in as one of the fixture users."""
+
+        self.client.set_cookie(
+            current_app.config['SESSION_COOKIE_NAME'],
+            self.login_cookies[user_id],
+        )
+
+    def assertFlashed(self, message):
+        """Fail unless `message` is waiting to be flashed on the next page.
+
+        Lets a test check a redirect's flash without requesting the page it
+        redirects to.
+        """
+
+        with self.client.session_transaction() as sess:
+            flashed = [msg for _category, msg in sess.get('_flashes', [])]
+
+        self.assertIn(message, flashed)
+
+    def assertInBody(self, text, resp):
+        """Fail unless `text` appears in the response body.
+
+        Searches the raw bytes, so the page isn't decoded just to check it.
+        """
+
+        self.assertIn(text.encode(), resp.data)
+
+    def assertNotInBody(self, text, resp):
+        """Fail if `text` appears in the response body."""
+
+        self.assertNotIn(text.encode(), resp.data)
+
+
+@contextmanager
+def count_queries():
+    """Record every SQL statement run inside the block.
+
+    Yields the list of statements, which fills up as queries execute:
+
+        with count_queries() as queries:
+            c.get("/")
+        self.assertLessEqual(len(queries), 3)
+
+    SAVEPOINT bookkeeping from DBTestCase isn't counted, since outside the
+    tests those commits are a plain COMMIT.
+    """
+
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not SAVEPOINT_STATEMENT.match(statement):
+            queries.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)